@@ -0,0 +1,340 @@
+"""
+Aggregate the output of pred_mask.py into county-day mask-wearing rates.
+
+The score csv and the tweet metadata table are both read in chunks, so a
+year of data never has to fit in memory at once. Aggregates are stored as
+counts, which makes them additive: passing the previous aggregate file with
+--state folds a new day's scores into it without recomputing history.
+"""
+
+from __future__ import print_function
+import os
+import argparse
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# score columns written by pred_mask.py
+score_cols = ["mask", "faces", "covering", "medical"]
+# visual attributes are only meaningful for images that contain a mask
+visattr_cols = score_cols[1:]
+count_cols = ["n_images"] + ["n_" + c for c in score_cols]
+key_cols = ["county", "day"]
+# twitter's created_at, e.g. "Wed Oct 10 20:19:24 +0000 2018"
+twitter_time_format = "%a %b %d %H:%M:%S %z %Y"
+# ids without leading zeros that fit in int64 (tweet and media ids do)
+int_id_pattern = r"0|[1-9][0-9]{0,18}"
+
+
+def image_id(imgpaths):
+    """
+    image id of each path in pred_mask.py output (file name without extension)
+    """
+    names = imgpaths.astype(str).str.rsplit("/", n = 1).str[-1]
+    return names.str.rsplit(".", n = 1).str[0]
+
+def int_ids(ids):
+    """
+    convert string ids to int64, returning the ids and a mask of the ones
+    that are numeric (the others are set to -1)
+    """
+    ids = pd.Series(ids).astype(str)
+    valid = ids.str.fullmatch(int_id_pattern).fillna(False) \
+               .values.astype(bool)
+    # 19 digit ids can still overflow; equal-length digit strings
+    # compare like numbers
+    valid = valid & ((ids.str.len().values < 19) |
+                     (ids.values.astype(str) <= str(np.iinfo(np.int64).max)))
+    out = np.full(len(ids), -1, dtype = np.int64)
+    out[valid] = ids[valid].astype(np.int64).values
+    return out, valid
+
+def parse_thresholds(specs):
+    """
+    parse "col=value" threshold arguments, default 0.5 for every score column
+    """
+    thresholds = dict((c, 0.5) for c in score_cols)
+    for spec in specs:
+        col, sep, value = spec.partition("=")
+        if not sep or col not in thresholds:
+            raise ValueError("invalid threshold '{}', expected one of {} "
+                             "followed by =value".format(spec, score_cols))
+        thresholds[col] = float(value)
+    return thresholds
+
+def load_scores(csvpath, thresholds, chunksize):
+    """
+    read pred_mask.py output in chunks and binarize the scores.
+
+    returns a hash index over image ids and an int8 flag matrix aligned
+    with it (one column per score column). The index is the only part held
+    in memory; numeric ids are stored as int64 (about 8 bytes per image plus
+    the hash table), other ids as python strings, which take several times
+    more.
+    """
+    ids = []
+    flags = []
+    numeric = True
+    for chunk in pd.read_csv(csvpath,
+                             usecols = ["imgpath"] + score_cols,
+                             chunksize = chunksize):
+        flag = np.empty((len(chunk), len(score_cols)), dtype = np.int8)
+        for j, col in enumerate(score_cols):
+            flag[:, j] = chunk[col].values >= thresholds[col]
+        # visual attributes count only when the mask itself is detected
+        flag[:, 1:] &= flag[:, :1]
+        chunk_ids = image_id(chunk["imgpath"])
+        if numeric:
+            as_int, valid = int_ids(chunk_ids)
+            if valid.all():
+                chunk_ids = as_int
+            else:
+                # fall back to string ids for the whole file
+                numeric = False
+                ids = [i.astype(str).astype(object) for i in ids]
+        if not numeric:
+            chunk_ids = chunk_ids.values.astype(object)
+        ids.append(chunk_ids)
+        flags.append(flag)
+
+    if not ids:
+        return pd.Index([], dtype = object), np.zeros((0, len(score_cols)),
+                                                       dtype = np.int8)
+    index = pd.Index(np.concatenate(ids))
+    flags = np.concatenate(flags)
+    if not index.is_unique:
+        # an image scored twice keeps its last score
+        keep = ~index.duplicated(keep = "last")
+        index, flags = index[keep], flags[keep]
+    return index, flags
+
+def iter_metadata(path, columns, chunksize):
+    """
+    yield the tweet metadata table as DataFrame chunks.
+
+    Parquet (.parquet) and Arrow IPC (.arrow, .feather) files are read batch
+    by batch with pyarrow; anything else is read as csv.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".parquet", ".arrow", ".feather"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to read {}".format(path))
+        if ext == ".parquet":
+            batches = pq.ParquetFile(path).iter_batches(
+                                batch_size = chunksize, columns = columns)
+        else:
+            reader = pa.ipc.open_file(path)
+            batches = (reader.get_batch(i).select(columns)
+                       for i in range(reader.num_record_batches))
+        for batch in batches:
+            # ids and counties as strings like the csv path; integer columns
+            # with nulls would otherwise come back as float64
+            table = pa.Table.from_batches([batch])
+            for name in columns[:2]:
+                i = table.schema.get_field_index(name)
+                table = table.set_column(i, name,
+                                         table.column(name).cast(pa.string()))
+            yield table.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols = columns,
+                                 dtype = {columns[0]: str, columns[1]: str},
+                                 chunksize = chunksize):
+            yield chunk
+
+def aggregate_chunk(meta, columns, index, flags, time_format = None):
+    """
+    join one metadata chunk with the scores and count per county-day.
+
+    columns are the metadata names of the id, county and time columns;
+    readers may return them in file order, so they are selected by name.
+    time_format is passed to pd.to_datetime, None lets pandas infer it.
+    """
+    id_col, county_col, time_col = columns
+    meta = meta[columns].rename(columns = {id_col: "id",
+                                           county_col: "county",
+                                           time_col: "time"})
+    meta = meta.dropna()
+    # hash join: position of every tweet image in the score index
+    if index.dtype == np.int64:
+        # non-numeric ids become -1, which never matches
+        pos = index.get_indexer(int_ids(meta["id"])[0])
+    else:
+        pos = index.get_indexer(meta["id"].astype(str))
+    found = pos >= 0
+    if not found.any():
+        return None
+    meta = meta[found]
+    pos = pos[found]
+
+    counts = pd.DataFrame(flags[pos], columns = count_cols[1:],
+                          index = meta.index)
+    counts["n_images"] = 1
+    counts["county"] = meta["county"].astype(str).values
+    # days are UTC days, not the county's local day
+    counts["day"] = pd.to_datetime(meta["time"], utc = True,
+                                   format = time_format,
+                                   errors = "coerce") \
+                      .dt.strftime("%Y-%m-%d").values
+    # unparseable timestamps become NaN and are dropped
+    counts = counts.dropna(subset = ["day"])
+    return counts.groupby(key_cols)[count_cols].sum()
+
+def merge_counts(parts):
+    """sum count frames that share county-day keys"""
+    parts = [p for p in parts if p is not None and len(p)]
+    if not parts:
+        empty = pd.DataFrame(columns = key_cols + count_cols)
+        return empty.set_index(key_cols)
+    return pd.concat(parts).groupby(level = key_cols).sum()
+
+def sources_path(path):
+    """sidecar listing the score files already added to an aggregate csv"""
+    return path + ".sources"
+
+def file_digest(path):
+    """sha1 of a file, read in blocks"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_sources(path):
+    """digest -> score file path for every score file in an aggregate"""
+    sources = {}
+    if os.path.isfile(sources_path(path)):
+        with open(sources_path(path)) as f:
+            for line in f:
+                digest, _, score_path = line.rstrip("\n").partition("\t")
+                sources[digest] = score_path
+    return sources
+
+def load_state(path):
+    """load previously written aggregates (counts only, rates are derived)"""
+    state = pd.read_csv(path, dtype = {"county": str, "day": str},
+                        usecols = key_cols + count_cols)
+    return state.set_index(key_cols)
+
+def add_rates(agg):
+    """
+    mask rate is over all images, visual attribute rates over mask images
+    """
+    agg = agg.astype(np.int64)
+    n_mask = agg["n_mask"].where(agg["n_mask"] > 0)
+    agg["mask_rate"] = agg["n_mask"] / agg["n_images"]
+    for col in visattr_cols:
+        agg[col + "_rate"] = agg["n_" + col] / n_mask
+    return agg
+
+def main():
+    thresholds = parse_thresholds(args.threshold)
+
+    sources = {}
+    if args.state and os.path.isfile(args.state):
+        sources = load_sources(args.state)
+    digest = file_digest(args.score_csvpath)
+    if digest in sources:
+        raise ValueError("{} was already added to {} (as {})"
+                         .format(args.score_csvpath, args.state,
+                                 sources[digest]))
+    sources[digest] = os.path.abspath(args.score_csvpath)
+
+    print("*** loading scores from {}".format(args.score_csvpath))
+    index, flags = load_scores(args.score_csvpath, thresholds,
+                               args.chunksize)
+    print("*** {} scored images".format(len(index)))
+
+    print("*** joining with tweet metadata in {}".format(args.meta_path))
+    columns = [args.id_col, args.county_col, args.time_col]
+    parts = []
+    for meta in iter_metadata(args.meta_path, columns, args.chunksize):
+        parts.append(aggregate_chunk(meta, columns, index, flags,
+                                     args.time_format or None))
+        # fold partial results regularly so memory stays bounded
+        if len(parts) >= 16:
+            parts = [merge_counts(parts)]
+    agg = merge_counts(parts)
+    print("*** {} images matched tweet metadata"
+          .format(int(agg["n_images"].sum())))
+
+    if args.state:
+        if os.path.isfile(args.state):
+            print("*** updating aggregates in {}".format(args.state))
+            agg = merge_counts([load_state(args.state), agg])
+        else:
+            print("*** no aggregates found at {}, starting new"
+                  .format(args.state))
+
+    agg = add_rates(agg).sort_index()
+    agg.to_csv(args.output_csvpath)
+    with open(sources_path(args.output_csvpath), "w") as f:
+        for digest, score_path in sources.items():
+            f.write("{}\t{}\n".format(digest, score_path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--score_csvpath",
+                        type=str,
+                        required = True,
+                        help = "csv file written by pred_mask.py"
+                        )
+    parser.add_argument("--meta_path",
+                        type=str,
+                        required = True,
+                        help = "tweet metadata table "
+                        "(.parquet, .arrow/.feather or .csv)"
+                        )
+    parser.add_argument("--output_csvpath",
+                        type=str,
+                        default = "county_day.csv",
+                        help = "path to output csv file"
+                        )
+    parser.add_argument("--state",
+                        type=str,
+                        default = "",
+                        help = "previous aggregate csv to add the new "
+                        "counts to; score files listed in its .sources "
+                        "sidecar are refused"
+                        )
+    parser.add_argument("--id_col",
+                        type=str,
+                        default = "image_id",
+                        help = "metadata column matching the image file name "
+                        "without extension"
+                        )
+    parser.add_argument("--county_col",
+                        type=str,
+                        default = "county",
+                        help = "metadata column with the county (e.g. FIPS)"
+                        )
+    parser.add_argument("--time_col",
+                        type=str,
+                        default = "created_at",
+                        help = "metadata column with the tweet timestamp "
+                        "(grouped by UTC day, not the county's local day)"
+                        )
+    parser.add_argument("--time_format",
+                        type=str,
+                        default = twitter_time_format,
+                        help = "strftime format of --time_col, empty to let "
+                        "pandas infer it (default: twitter's created_at)"
+                        )
+    parser.add_argument("--threshold",
+                        type=str,
+                        action = "append",
+                        default = [],
+                        help = "score threshold as col=value, e.g. mask=0.6 "
+                        "(default 0.5 for every column)"
+                        )
+    parser.add_argument("--chunksize",
+                        type = int,
+                        default = 500000,
+                        help = "rows read per chunk",
+                        )
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,293 @@
+"""
+DataLoader autotuner shared by pred_mask.py and train_mask.py.
+
+Short trial passes through the dataset and the model are timed for a range
+of batch sizes, worker counts, prefetch depths and torch thread counts. The
+fastest configuration that stays under the memory cap is written to a json
+profile, keyed by script and device, which later runs load automatically.
+
+The memory cap is checked against GPU memory on CUDA runs. On CPU it needs
+psutil; without it CPU trials are not capped.
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+# used when neither the command line nor the profile gives a value
+default_config = {"batch_size": 8, "workers": 4, "prefetch_factor": 2,
+                  "threads": None}
+
+
+def profile_key(script, cuda):
+    """profiles differ between scripts and between CPU and GPU runs"""
+    return "{}-{}".format(script, "cuda" if cuda else "cpu")
+
+def read_profiles(path):
+    """
+    all profiles in path; a missing file gives none, an unreadable one
+    gives none with a warning
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+        if not isinstance(profiles, dict):
+            raise ValueError("not a json object")
+    except ValueError as e:
+        print("*** warning: ignoring invalid loader profile {} ({})"
+              .format(path, e))
+        return {}
+    return profiles
+
+def load_profile(path, key):
+    """return the saved configuration for key, or None"""
+    profile = read_profiles(path).get(key)
+    return profile if isinstance(profile, dict) else None
+
+def save_profile(path, key, config):
+    """write config under key, keeping the entries of other keys"""
+    profiles = read_profiles(path)
+    profiles[key] = config
+    # write to a temporary file first so an interrupted run never leaves
+    # a truncated profile behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent = 2, sort_keys = True)
+    os.replace(tmp_path, path)
+
+def apply_profile(args, key):
+    """
+    fill loader settings not given on the command line from the profile,
+    falling back to the defaults. The settings given on the command line
+    are kept in args.fixed_loader so --autotune leaves them alone.
+    """
+    args.fixed_loader = dict((name, getattr(args, name))
+                             for name in default_config
+                             if getattr(args, name) is not None)
+    profile = load_profile(args.profile, key)
+    if profile:
+        print("*** using loader profile '{}' from {}".format(key, args.profile))
+    for name, value in default_config.items():
+        if getattr(args, name) is None:
+            if profile and profile.get(name) is not None:
+                value = profile[name]
+            setattr(args, name, value)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+def loader_kwargs(config, cuda, persistent = False):
+    """
+    DataLoader keyword arguments for a configuration. persistent keeps the
+    workers alive between epochs and is only worth it for loaders that are
+    iterated more than once.
+    """
+    kwargs = {"batch_size": config["batch_size"],
+              "num_workers": config["workers"],
+              "pin_memory": cuda}
+    if config["workers"] > 0:
+        kwargs["prefetch_factor"] = config["prefetch_factor"]
+        kwargs["persistent_workers"] = persistent
+    return kwargs
+
+def default_mem_cap(cuda):
+    """
+    90% of GPU memory or 80% of physical memory in MB, None when the
+    physical memory is unknown (no psutil)
+    """
+    if cuda:
+        total = torch.cuda.get_device_properties(0).total_memory
+        return 0.9 * total / 2**20
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return 0.8 * psutil.virtual_memory().total / 2**20
+
+def cpu_memory():
+    """
+    current memory of this process and its workers in MB, None without
+    psutil. Workers are counted by their unique pages only, so the pages
+    they share with the parent after fork are not counted once per worker.
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    proc = psutil.Process()
+    total = proc.memory_info().rss
+    for child in proc.children(recursive = True):
+        try:
+            total += child.memory_full_info().uss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return total / 2**20
+
+def trial(dataset, step, config, cuda, n_batches = 10, warmup = 2):
+    """
+    run step on a number of batches and return (images per second, peak MB
+    of this trial), or None when the configuration runs out of memory.
+
+    The warmup covers at least the workers * prefetch_factor batches the
+    loader requests up front, and at least n_batches and four times that
+    many batches are timed after it, so the timed window measures steady
+    state loading rather than batches prefetched during the warmup. When
+    the dataset is too small for that, all batches are timed from loader
+    creation, worker start-up included.
+    """
+    batch_size = config["batch_size"]
+    in_flight = max(1, config["workers"] * config["prefetch_factor"])
+    warmup = max(warmup, in_flight)
+    n_timed = max(n_batches, 4 * in_flight)
+    n = min(len(dataset), (warmup + n_timed) * batch_size)
+    if n < (warmup + n_timed) * batch_size:
+        warmup = 0
+    subset = Subset(dataset, range(n))
+    if config["threads"]:
+        torch.set_num_threads(config["threads"])
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+    n_imgs = 0
+    start = None
+    peak = None
+    sample_time = 0
+    try:
+        if warmup == 0:
+            start = time.time()
+        data_loader = DataLoader(subset,
+                                 **loader_kwargs(config, cuda,
+                                                 persistent = False))
+        for i, sample in enumerate(data_loader):
+            if warmup and i == warmup:
+                # worker start-up and first batches are not counted
+                if cuda:
+                    torch.cuda.synchronize()
+                start = time.time()
+            step(sample)
+            if start is not None:
+                n_imgs += len(sample["image"])
+            if not cuda:
+                # sampled while the workers are alive, not timed
+                t = time.time()
+                mem = cpu_memory()
+                if mem is not None:
+                    peak = max(peak or 0, mem)
+                if start is not None:
+                    sample_time += time.time() - t
+        if cuda:
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() / 2**20
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        if cuda:
+            torch.cuda.empty_cache()
+        return None
+    return n_imgs / (time.time() - start - sample_time), peak
+
+def search(dataset, step, cuda, mem_cap = None, n_batches = 10,
+           fixed = None):
+    """
+    coordinate search over batch size, workers, prefetch depth and threads.
+
+    The starting configuration is measured first, then each setting is
+    tuned in turn with the others fixed at their current best value.
+    Settings in fixed are not searched. Returns the best configuration with
+    its throughput, or None when no trial succeeded.
+    """
+    fixed = fixed or {}
+    if mem_cap is None:
+        mem_cap = default_mem_cap(cuda)
+    n_cpu = os.cpu_count() or 1
+    candidates = [
+        ("batch_size", [4, 8, 16, 32, 64, 128]),
+        ("workers", sorted(set(w for w in [0, 1, 2, 4, 8, 16]
+                               if w <= n_cpu))),
+        ("prefetch_factor", [2, 4, 8]),
+        ("threads", sorted(set(t for t in [1, 2, 4, n_cpu // 2, n_cpu]
+                               if t >= 1))),
+    ]
+    best = dict(default_config,
+                workers = min(default_config["workers"], n_cpu),
+                threads = torch.get_num_threads())
+    best.update(fixed)
+    best_speed = 0
+    tried = set()
+
+    if mem_cap is None:
+        print("*** autotuning data loading (no memory cap, install psutil "
+              "to measure CPU memory)")
+    else:
+        print("*** autotuning data loading (memory cap {:.0f} MB)"
+              .format(mem_cap))
+    # the starting configuration is a candidate of its own
+    candidates.insert(0, (None, [None]))
+    for name, values in candidates:
+        if name in fixed:
+            continue
+        if name == "prefetch_factor" and best["workers"] == 0:
+            # prefetching only applies to worker processes
+            continue
+        current = best
+        for value in values:
+            config = dict(current)
+            if name is not None:
+                config[name] = value
+            if tuple(sorted(config.items())) in tried:
+                # the current best, measured in an earlier sweep
+                continue
+            tried.add(tuple(sorted(config.items())))
+            if len(dataset) < config["batch_size"]:
+                print("  {}: too few images".format(config))
+                break
+            result = trial(dataset, step, config, cuda, n_batches = n_batches)
+            if result is None or (mem_cap is not None and
+                                  result[1] is not None and
+                                  result[1] > mem_cap):
+                print("  {}: out of memory".format(config))
+                if name == "batch_size":
+                    # larger batches only need more memory
+                    break
+                continue
+            speed, mem = result
+            print("  {}: {:.1f} img/s, {} MB".format(
+                    config, speed,
+                    "n/a" if mem is None else "{:.0f}".format(mem)))
+            if speed > best_speed:
+                best, best_speed = config, speed
+
+    if cuda:
+        torch.cuda.empty_cache()
+    if best_speed == 0:
+        print("*** no loader configuration could be measured")
+        return None
+    best = dict(best, throughput = round(best_speed, 2))
+    print("*** best loader configuration: {}".format(best))
+    return best
+
+def autotune(args, key, dataset, step):
+    """
+    run the search, save it to the profile and apply it to args. Settings
+    given on the command line (args.fixed_loader) are not searched.
+    """
+    threads = torch.get_num_threads()
+    best = search(dataset, step, args.cuda, mem_cap = args.mem_cap,
+                  fixed = getattr(args, "fixed_loader", None))
+    if best is None:
+        print("*** loader profile not saved, keeping current settings")
+        torch.set_num_threads(threads)
+        return
+    save_profile(args.profile, key, best)
+    print("*** saved loader profile '{}' to {}".format(key, args.profile))
+    for name in default_config:
+        setattr(args, name, best[name])
+    if args.threads:
+        torch.set_num_threads(args.threads)
@@ -18,6 +18,7 @@ from torch.autograd import Variable
 import torchvision.models as models
 
 from util import MaskDatasetEval, modified_resnet50
+from autotune import profile_key, apply_profile, loader_kwargs, autotune
 
 
 def eval_one_dir(img_dir, model):
@@ -28,8 +29,7 @@ def eval_one_dir(img_dir, model):
         # make dataloader
         dataset = MaskDatasetEval(img_dir = img_dir)
         data_loader = DataLoader(dataset,
-                                num_workers = args.workers,
-                                batch_size = args.batch_size)
+                                **loader_kwargs(vars(args), args.cuda))
         # load model
 
         outputs = []
@@ -67,6 +67,18 @@ def main():
     if args.cuda:
         model = model.cuda()
     model.load_state_dict(torch.load(args.model)['state_dict'])
+
+    if args.autotune:
+        # same forward pass as eval_one_dir
+        model.eval()
+        def step(sample):
+            input = sample['image']
+            if args.cuda:
+                input = input.cuda()
+            model(Variable(input)).cpu()
+        autotune(args, profile_key("pred", args.cuda),
+                 MaskDatasetEval(img_dir = args.img_dir), step)
+
     print("*** calculating the model output of the images in {img_dir}"
             .format(img_dir = args.img_dir))
 
@@ -100,14 +112,44 @@ if __name__ == "__main__":
                         )
     parser.add_argument("--workers",
                         type = int,
-                        default = 4,
-                        help = "number of workers",
+                        default = None,
+                        help = "number of workers (default: profile or 4)",
                         )
     parser.add_argument("--batch_size",
                         type = int,
-                        default = 8,
-                        help = "batch size",
+                        default = None,
+                        help = "batch size (default: profile or 8)",
+                        )
+    parser.add_argument("--prefetch_factor",
+                        type = int,
+                        default = None,
+                        help = "batches prefetched per worker "
+                        "(default: profile or 2)",
+                        )
+    parser.add_argument("--threads",
+                        type = int,
+                        default = None,
+                        help = "torch intra-op threads "
+                        "(default: profile or torch default)",
+                        )
+    parser.add_argument("--profile",
+                        type = str,
+                        default = "loader_profile.json",
+                        help = "loader profile written by --autotune and "
+                        "loaded automatically when it exists",
+                        )
+    parser.add_argument("--autotune",
+                        action = "store_true",
+                        help = "search for the fastest loader settings "
+                        "before running and save them to --profile",
+                        )
+    parser.add_argument("--mem_cap",
+                        type = float,
+                        default = None,
+                        help = "memory cap in MB for --autotune "
+                        "(default: 90%% of GPU / 80%% of RAM)",
                         )
     args = parser.parse_args()
+    apply_profile(args, profile_key("pred", args.cuda))
 
     main()
@@ -14,6 +14,7 @@ import numpy as np
 import pandas as pd
 import time
 import shutil
+import copy
 from PIL import Image
 from sklearn.metrics import accuracy_score, mean_squared_error
 
@@ -26,6 +27,7 @@ import torchvision.transforms as transforms
 import torchvision.models as models
 
 from util import MaskDataset, modified_resnet50, AverageMeter, Lighting
+from autotune import profile_key, apply_profile, loader_kwargs, autotune
 
 
 # for indexing output of the model
@@ -321,16 +323,37 @@ def main():
                         transforms.ToTensor(),
                         normalize,
                     ]))
+
+    if args.autotune:
+        # a training step without the optimizer update; the model state is
+        # restored afterwards so batch norm statistics are left untouched
+        state = copy.deepcopy(model.state_dict())
+        model.train()
+        def step(sample):
+            input, target = sample['image'], sample['label']
+            if args.cuda:
+                input = input.cuda()
+                for k, v in target.items():
+                    target[k] = v.cuda()
+            target_var = {}
+            for k,v in target.items():
+                target_var[k] = Variable(v)
+            output = model(Variable(input))
+            losses, scores, N_mask = calculate_loss(output, target_var,
+                                                    criterions)
+            sum(losses).backward()
+            optimizer.zero_grad()
+        autotune(args, profile_key("train", args.cuda), train_dataset, step)
+        model.load_state_dict(state)
+
     train_loader = DataLoader(
                     train_dataset,
-                    num_workers = args.workers,
-                    batch_size = args.batch_size,
-                    shuffle = True
+                    shuffle = True,
+                    **loader_kwargs(vars(args), args.cuda, persistent = True)
                     )
     val_loader = DataLoader(
                     val_dataset,
-                    num_workers = args.workers,
-                    batch_size = args.batch_size)
+                    **loader_kwargs(vars(args), args.cuda))
 
 
     for epoch in range(args.start_epoch, args.epochs):
@@ -373,13 +396,42 @@ if __name__ == "__main__":
                         )
     parser.add_argument("--workers",
                         type = int,
-                        default = 4,
-                        help = "number of workers",
+                        default = None,
+                        help = "number of workers (default: profile or 4)",
                         )
     parser.add_argument("--batch_size",
                         type = int,
-                        default = 8,
-                        help = "batch size",
+                        default = None,
+                        help = "batch size (default: profile or 8)",
+                        )
+    parser.add_argument("--prefetch_factor",
+                        type = int,
+                        default = None,
+                        help = "batches prefetched per worker "
+                        "(default: profile or 2)",
+                        )
+    parser.add_argument("--threads",
+                        type = int,
+                        default = None,
+                        help = "torch intra-op threads "
+                        "(default: profile or torch default)",
+                        )
+    parser.add_argument("--profile",
+                        type = str,
+                        default = "loader_profile.json",
+                        help = "loader profile written by --autotune and "
+                        "loaded automatically when it exists",
+                        )
+    parser.add_argument("--autotune",
+                        action = "store_true",
+                        help = "search for the fastest loader settings "
+                        "before training and save them to --profile",
+                        )
+    parser.add_argument("--mem_cap",
+                        type = float,
+                        default = None,
+                        help = "memory cap in MB for --autotune "
+                        "(default: 90%% of GPU / 80%% of RAM)",
                         )
     parser.add_argument("--epochs",
                         type = int,
@@ -416,6 +468,7 @@ if __name__ == "__main__":
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
     args = parser.parse_args()
+    apply_profile(args, profile_key("train", args.cuda))
 
     if args.cuda:
         mask_idx = mask_idx.cuda()